@@ -37,7 +37,8 @@ def main():
 
     arg("source", type=argparse.FileType("r"), help=\
         "path to csv file with coordinates for origin and destination points")
-    arg("-o", "--output", type=argparse.FileType("w"), default=sys.stdout,
+    arg("-o", "--output", type=argparse.FileType("w", bufsize=1 << 20),
+        default=sys.stdout,
         help="location to write output. default to standard output")
 
     try:
@@ -1,9 +1,14 @@
 import os
 import enum
+import time
 import logging
+import functools
 import requests
 import threading
-from furl import furl
+from types import MappingProxyType
+from contextvars import ContextVar
+from urllib.parse import urlencode
+from requests.adapters import HTTPAdapter
 from contextlib import contextmanager
 from dotenv import find_dotenv, load_dotenv
 from . import exceptions as exc
@@ -12,43 +17,114 @@ from . import exceptions as exc
 log = logging.getLogger(__name__)
 __all__ = [
     "EnumMixin", "OSRMProfile", "OSRMService", "OSRMClient",
-    "get_client", "config"
+    "Throttle", "load_config", "get_config", "get_client",
+    "get_distance_cache"
 ]
 
 
-# singleton instances: thread-local
-__threadlocal = threading.local()
+# config is read-only once loaded and so is shared by all threads
+_config = None
+_config_lock = threading.Lock()
 
-
-class AttrDict(dict):
-    def __getattr__(self, key):
-        if key in self:
-            return self[key]
-        return None
+# singleton instances: context-local (each thread starts with its own context)
+_client_var = ContextVar("client", default=None)
+_distances_var = ContextVar("distances", default=None)
 
 
 class EnumMixin:
+    @classmethod
+    @functools.lru_cache(maxsize=None)
+    def _lookup(cls):
+        # member names take precedence over member values
+        lookup = {c.value: c for c in cls}
+        lookup.update({c.name: c for c in cls})
+        return lookup
+
     @classmethod
     def resolve(cls, value):
         if isinstance(value, cls):
             return value
-        if value in [c.name for c in cls]:
-            return cls[value]
-        if value in [c.value for c in cls]:
-            return cls(value)
+
+        try:
+            member = cls._lookup().get(value)
+        except TypeError:
+            # unhashable values can't be members
+            member = None
+
+        if member is not None:
+            return member
 
         errmsg = f"Invalid value provided for {cls.__name__}: {value}"
         raise ValueError(errmsg)
 
 
+class Throttle:
+    """Spaces out requests made across threads by an interval which starts at
+    `min_interval` seconds, backs off when the server signals pressure (HTTP
+    429 or 5xx, honouring Retry-After) and recovers on successful responses.
+    """
+    BACKOFF_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, min_interval=1.0, max_interval=60.0):
+        if min_interval <= 0:
+            raise ValueError("min_interval must be greater than zero")
+
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.interval = min_interval
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """Blocks until the caller may make its next request.
+        """
+        with self._lock:
+            now = time.monotonic()
+            scheduled = max(now, self._next)
+            self._next = scheduled + self.interval
+
+        if scheduled > now:
+            time.sleep(scheduled - now)
+
+    def backoff(self, delay=None):
+        """Doubles the interval and, if given, holds off further requests for
+        delay seconds.
+        """
+        with self._lock:
+            self.interval = min(self.max_interval, self.interval * 2)
+            if delay is not None:
+                delay = min(self.max_interval, delay)
+                self._next = max(self._next, time.monotonic() + delay)
+
+    def update(self, resp):
+        """Adjusts the interval using the status of a response. Returns True
+        if the server signalled pressure and the request should be retried.
+        """
+        if resp.status_code not in self.BACKOFF_STATUSES:
+            with self._lock:
+                self.interval = max(self.min_interval, self.interval / 2)
+            return False
+
+        retry_after = resp.headers.get("Retry-After", "")
+        self.backoff(float(retry_after) if retry_after.isdigit() else None)
+        return True
+
+
 class APIClient:
     """Defines base interface expected of a client interacting with an
     external service.
     """
     SERVICE_NAME = None
-    DEFAULT_HEADERS = ()
-
-    def __init__(self, urlbase, apikey=None):
+    DEFAULT_HEADERS = (
+        ("Accept-Encoding", "gzip, deflate"),
+        ("Connection", "keep-alive"),
+    )
+    DEFAULT_TIMEOUT = 30
+    POOL_CONNECTIONS = 16
+    POOL_MAXSIZE = 64
+    MAX_RETRIES = 3
+
+    def __init__(self, urlbase, apikey=None, session=None, timeout=None):
         if "://" not in urlbase or urlbase.startswith("://"):
             raise ValueError("urlbase must specify a scheme")
         
@@ -57,12 +133,39 @@ class APIClient:
 
         self.urlbase = urlbase
         self.apikey = apikey
+        self.timeout = timeout or self.DEFAULT_TIMEOUT
+        self._default_headers = dict(self.DEFAULT_HEADERS)
 
-    def _build_url(self, urlpath=None, **params):
-        furlobj = furl(self.urlbase, path=urlpath, args=params)
-        log.debug(f"built service url: {furlobj.url}")
+        # a provided session is shared and thus owned by the caller
+        self._owns_session = session is None
+        self._session = session or self._create_session()
 
-        return furlobj
+    def _create_session(self):
+        """Returns a session whose connection pool is reused (keep-alive)
+        across all requests made by the client.
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=self.POOL_CONNECTIONS,
+            pool_maxsize=self.POOL_MAXSIZE,
+            max_retries=self.MAX_RETRIES
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def _finish_url(self, url, params):
+        """Returns url with params appended as its query string.
+        """
+        if params:
+            url = f"{url}?{urlencode(params, safe=',;')}"
+
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(f"built service url: {url}")
+        return url
+
+    def _build_url(self, urlpath=None, **params):
+        return self._finish_url(f"{self.urlbase}{urlpath or ''}", params)
 
     def __call__(self, urlpath=None, payload=None, headers=None, as_get=True):
         """Performs a request to an external service.
@@ -71,20 +174,36 @@ class APIClient:
         treated as the query params otherwise a POST request is made if as_get
         is False.
         """
-        request_headers = dict(self.DEFAULT_HEADERS)
-        request_headers.update(headers or {})
+        request_headers = self._default_headers
+        if headers:
+            request_headers = {**request_headers, **headers}
 
         if as_get:
-            furlobj = self._build_url(urlpath, **payload)
-            resp = requests.get(furlobj.url, headers=request_headers)
+            url = self._build_url(urlpath, **(payload or {}))
+            resp = self._session.get(
+                url, headers=request_headers, timeout=self.timeout
+            )
         else:
             payload = payload or []
-            request_url = self._build_url(urlpath)
-            resp = request.post(
-                furlobj.url, headers=request_headers, json=payload
+            url = self._build_url(urlpath)
+            resp = self._session.post(
+                url, headers=request_headers, json=payload,
+                timeout=self.timeout
             )
         return resp
 
+    def close(self):
+        """Releases the pooled connections held by the client's session.
+        """
+        if self._owns_session:
+            self._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
     def __repr__(self):
         """Returns string representation for inistances.
         """
@@ -116,12 +235,21 @@ class OSRMClient(APIClient):
 
     def __init__(
         self, urlbase, apikey=None, service=None,
-        version="v1", profile=OSRMProfile.CAR
+        version="v1", profile=OSRMProfile.CAR, session=None, timeout=None
     ):
-        super().__init__(urlbase, apikey=apikey)
+        super().__init__(
+            urlbase, apikey=apikey, session=session, timeout=timeout
+        )
         self.service = OSRMService.resolve(service or "route")
         self.profile = OSRMProfile.resolve(profile)
         self.version = version or "v1"
+        self._path_prefix = (
+            f"/{self.service.value}/{self.version}/{self.profile.value}"
+        )
+        self._url_prefix = self.urlbase + self._path_prefix
+
+        # clients for other service/profile pairs sharing this client's session
+        self._clients = {}
 
     def _build_url(self, urlpath=None, **params):
         if not params:
@@ -129,79 +257,111 @@ class OSRMClient(APIClient):
         
         for entry in self.REQUIRED_PAYLOAD_ENTRIES:
             if entry not in params:
-                raise exc.ValidationError("'{entry}' missing from payload")
+                raise exc.ValidationError(f"'{entry}' missing from payload")
 
-        # ignore whatever urlpath that was provided and build another
-        urlpath = f"/{self.service.value}/{self.version}/{self.profile.value}"
-
-        # include coordinates
+        # ignore whatever urlpath that was provided and use the service url;
+        # coordinates are expected to be clean "long,lat" strings
         coordinates = params.pop("coordinates")
+        if isinstance(coordinates, str):
+            errmsg = "'coordinates' must be a sequence of 'long,lat' strings"
+            raise exc.ValidationError(errmsg)
+
         if not isinstance(coordinates, (list, tuple)):
             coordinates = list(coordinates)
 
-        coords = ";".join([c.strip() for c in coordinates if c])
-        urlpath = f"{urlpath}/{coords}.json"
-
-        return super()._build_url(urlpath, **params)
+        coords = ";".join(coordinates)
+        return self._finish_url(f"{self._url_prefix}/{coords}.json", params)
 
     @contextmanager
     def for_(self, service, profile):
-        yield self.__class__(self.urlbase, service, profile=profile)
-
-
-def load_config():
-    """Load configuration from ENV VARS for now.
+        key = (OSRMService.resolve(service), OSRMProfile.resolve(profile))
+        client = self._clients.get(key)
+        if client is None:
+            # share session (and so the connection pool) with the parent
+            client = self._clients.setdefault(key, self.__class__(
+                self.urlbase, self.apikey, service=key[0],
+                version=self.version, profile=key[1], session=self._session,
+                timeout=self.timeout
+            ))
+        yield client
+
+
+def _build_config():
+    """Returns configuration built from ENV VARS that begin with "ROUTE__".
+
+    Configs namespaced to the service name (ROUTE__<SERVICE>__*) become the
+    default configs by dropping the service name, overriding generic ones.
     """
     def norm(key):
-        # normalize ENV VAR names
-        return key[7:].lower().replace("_", ".")
-
-    if hasattr(__threadlocal, "config"):
-        return
+        # normalize ENV VAR names: OSRM__URLBASE => osrm.urlbase
+        return key.lower().replace("__", ".").replace("_", ".")
 
     load_dotenv(find_dotenv())
 
-    # read in all ENV VARS that begin with "ROUTE__"
-    config = AttrDict({
-        norm(key): value
-        for (key, value) in os.environ.items()
-        if key.startswith("ROUTE__")
-    })
+    generic_tag = "ROUTE__"
+    service = os.environ.get("ROUTE__SERVICE", "OSRM").upper()
+    service_tag = f"{generic_tag}{service}__"
 
-    # refine configs namespaced to provides service name so they become the
-    # default configs (by dropping the service name)...
-    service_tag = f"{config.service.upper()}."
-    for key in config.keys():
-        if key.upper().startswith(service_tag):
-            # drop service name in key
-            config[key[len(service_tag):]] = config[key]
-            del config[key]
+    def is_namespaced(item):
+        return item[0].startswith(service_tag)
 
-    setattr(__threadlocal, "config", config)
+    # service namespaced keys are sorted last so they shadow generic ones
+    return {
+        norm(key[len(service_tag):] if key.startswith(service_tag)
+             else key[len(generic_tag):]): value
+        for (key, value) in sorted(os.environ.items(), key=is_namespaced)
+        if key.startswith(generic_tag)
+    }
+
+
+def load_config():
+    """Load configuration from ENV VARS for now.
+
+    Config is loaded only once and shared as a read-only mapping.
+    """
+    global _config
+
+    if _config is None:
+        with _config_lock:
+            if _config is None:
+                _config = MappingProxyType(_build_config())
 
 
 def get_config():
-    """Returns the configuration dict stored on the thread-local if present
-    otherwise config is load from all available sources, set on thread-local
-    then returned.
+    """Returns the loaded configuration mapping, loading config from all
+    available sources first if not already loaded.
     """
-    if not hasattr(__threadlocal, "config"):
+    if _config is None:
         load_config()
 
-    return __threadlocal.config
+    return _config
 
 
 def get_client():
-    """Returns the APIClient instance set on the thread-local if present
-    otherwise one is created using available configuration and set on the
-    thread-local then returned.
+    """Returns the APIClient instance set on the context if present otherwise
+    one is created using available configuration and set on the context then
+    returned.
     """
-    if not hasattr(__threadlocal, "client"):
+    client = _client_var.get()
+    if client is None:
         config = get_config()
 
         service = config.get("engine", "OSRM")
         client_cls = OSRMClient if service == "OSRM" else APIClient
-        client = client_cls(config.urlbase, config.apikey)
-        setattr(__threadlocal, "client", client)
+        client = client_cls(config.get("urlbase"), config.get("apikey"))
+        _client_var.set(client)
+
+    return client
+
+
+def get_distance_cache():
+    """Returns the dict used to memoize distances between (origin, destination)
+    coordinate pairs stored on the context if present otherwise an empty one
+    is created, set on the context then returned.
+    """
+    distances = _distances_var.get()
+    if distances is None:
+        distances = {}
+        _distances_var.set(distances)
 
-    return __threadlocal.client
+    return distances
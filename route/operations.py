@@ -1,71 +1,318 @@
 import csv
-import time
-import random
+import logging
 import requests
-from furl import furl
-from collections import OrderedDict
+import contextvars
+from math import isfinite
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 
-from .common import get_client, AttrDict, OSRMService, OSRMProfile
+try:
+    import orjson as json
+except ImportError:
+    import json
 
+from . import exceptions as exc
+from .common import (
+    get_client, get_config, get_distance_cache, Throttle,
+    OSRMService, OSRMProfile
+)
 
-def compute_distances(origin, *destinations):
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CONCURRENCY = 8
+# max number of coordinates (origin included) sent in a single table request
+DEFAULT_TABLE_SIZE = 100
+# the public OSRM demo server allows at most 1 request per second
+DEFAULT_RATELIMIT = 1.0
+MAX_ATTEMPTS = 3
+COORDS_PRECISION = 6
+
+
+def _coords(long, lat):
+    """Returns the "long,lat" string for a point expected by the routing
+    service, rounded so near-duplicate points collapse into one, or None if
+    either value isn't a valid number.
+    """
+    try:
+        (long, lat) = (float(long), float(lat))
+    except ValueError:
+        return None
+
+    if not (isfinite(long) and isfinite(lat)):
+        return None
+
+    # fixed-point as the service can't parse scientific notation e.g. 1e-05
+    return f"{long:.{COORDS_PRECISION}f},{lat:.{COORDS_PRECISION}f}"
+
+
+def _concurrency():
+    """Returns the configured number of origins processed concurrently.
+    """
+    value = get_config().get("concurrency") or DEFAULT_CONCURRENCY
+    try:
+        concurrency = int(value)
+    except ValueError:
+        concurrency = 0
+
+    if concurrency < 1:
+        errmsg = f"concurrency must be a positive integer: {value}"
+        raise exc.ValidationError(errmsg)
+    return concurrency
+
+
+def _throttle():
+    """Returns a Throttle limiting requests to the configured rate (requests
+    per second).
+    """
+    value = get_config().get("ratelimit") or DEFAULT_RATELIMIT
+    try:
+        ratelimit = float(value)
+    except ValueError:
+        ratelimit = 0
+
+    if not ratelimit > 0:
+        errmsg = f"ratelimit must be a number greater than zero: {value}"
+        raise exc.ValidationError(errmsg)
+    return Throttle(1.0 / ratelimit)
+
+
+def _table_size():
+    """Returns the configured max number of coordinates per table request.
+    """
+    value = get_config().get("max.table.size") or DEFAULT_TABLE_SIZE
+    try:
+        size = int(value)
+    except ValueError:
+        size = 0
+
+    if size < 2:
+        errmsg = f"max table size must be an integer of at least 2: {value}"
+        raise exc.ValidationError(errmsg)
+    return size
+
+
+def _json(resp):
+    """Returns the parsed json body of a response, or an empty dict if there
+    is no response or its body isn't valid json.
+    """
+    if resp is None:
+        return {}
+
+    try:
+        return json.loads(resp.content)
+    except ValueError:
+        return {}
+
+
+def _request(client, throttle, payload):
+    """Performs a request once the throttle permits it, retrying requests
+    that failed or the server pushed back on. Returns None if every attempt
+    failed to get a response.
+    """
+    resp = None
+    for _ in range(MAX_ATTEMPTS):
+        throttle.wait()
+        try:
+            resp = client(payload=payload)
+        except requests.RequestException as ex:
+            log.warning(f"request to routing service failed: {ex}")
+            throttle.backoff()
+            resp = None
+            continue
+
+        if not throttle.update(resp):
+            break
+    return resp
+
+
+def _table_distances(client, throttle, origin_coords, dests_coords):
+    """Returns the distances from the origin to each of the destinations as
+    computed with a single OSRM table request, or None if the body of a
+    successful response is malformed.
+
+    Distances are reported as "?" if the request failed or was rejected, as
+    falling back to more requests would only add to the server's load.
+    """
+    coordinates = [origin_coords, *dests_coords]
+    payload = {
+        "coordinates": coordinates,
+        "sources": "0",
+        "destinations": ";".join(str(i) for i in range(1, len(coordinates))),
+        "annotations": "distance",
+    }
+
+    resp = _request(client, throttle, payload)
+    if resp is None or resp.status_code != 200:
+        return ["?"] * len(dests_coords)
+
+    data = _json(resp)
+    if data.get("code") != "Ok" or not data.get("distances"):
+        return None
+
+    row = data["distances"][0]
+    if not isinstance(row, list) or len(row) != len(dests_coords):
+        return None
+
+    # post-process the row in a single pass; unreachable destinations come
+    # back as null (or a non-finite value) and are reported as "?"
+    return [
+        value / 100.0
+        if isinstance(value, (int, float)) and isfinite(value) else "?"
+        for value in row
+    ]
+
+
+def _route_distances(client, throttle, origin_coords, dests_coords):
+    """Returns the distances from the origin to each of the destinations as
+    computed with an OSRM route request per destination.
+
+    Requests are made serially as this runs within an origin worker and all
+    requests are paced by the shared throttle anyway.
+    """
+    distances = []
+    for dest_coords in dests_coords:
+        payload = {"coordinates": [origin_coords, dest_coords]}
+        data = _json(_request(client, throttle, payload))
+
+        if data.get("code") != "Ok" or not data.get("routes"):
+            distances.append("?")
+            continue
+
+        route = data["routes"][0]
+        distance = route.get("distance") if route else None
+        if isinstance(distance, (int, float)) and isfinite(distance):
+            distances.append(distance / 100.0)
+        else:
+            distances.append("?")
+
+    return distances
+
+
+def compute_distances(origin, *destinations, throttle=None):
     """Returns a table of the distances from a single source point to multiple
     destination points.
+
+    The origin is a `(long, lat)` tuple while each destination is a
+    `(lat, long, coords)` tuple where coords is the preformatted "long,lat"
+    string expected by the routing service (None if invalid, in which case
+    its distance is reported as "?"). A Throttle shared across concurrent
+    calls can be provided via throttle.
     """
     client = get_client()
+    cache = get_distance_cache()
 
-    origin_coords = "{},{}".format(*origin)
-    with client.for_(OSRMService.ROUTE, OSRMProfile.CAR) as cl:
-        for dest in destinations:
-            dest_coords = "{},{}".format(dest["dest_long"], dest["dest_lat"])
-            payload = {"coordinates": [origin_coords, dest_coords]}
+    # only query for distinct valid destinations not already computed
+    origin_coords = _coords(*origin)
+    dests_coords = list(OrderedDict.fromkeys(
+        dest[2] for dest in destinations
+        if dest[2] is not None and (origin_coords, dest[2]) not in cache
+    ))
 
-            resp = cl(payload=payload)
-            data = AttrDict(resp.json())
+    found = {}
+    if origin_coords is not None and dests_coords:
+        # throttle in order not to overload server
+        throttle = throttle or _throttle()
 
-            if not (data.code and data.code == "Ok" and data.routes):
-                dest["distance"] = "?"
-                continue
+        # destinations are sent in chunks which fit within the server's
+        # max-table-size as oversized table requests are rejected
+        chunk_size = _table_size() - 1
+        for start in range(0, len(dests_coords), chunk_size):
+            chunk = dests_coords[start:start + chunk_size]
+            with client.for_(OSRMService.TABLE, OSRMProfile.CAR) as cl:
+                distances = _table_distances(
+                    cl, throttle, origin_coords, chunk
+                )
 
-            route = data.routes[0]
-            if not route:
-                dest["distance"] = "?"
-                continue
+            # fallback to a route request per destination
+            if distances is None:
+                with client.for_(OSRMService.ROUTE, OSRMProfile.CAR) as cl:
+                    distances = _route_distances(
+                        cl, throttle, origin_coords, chunk
+                    )
 
-            try:
-                dest["distance"] = route["distance"] / 100.0
-            except:
-                dest["distance"] = "?"
-            
-            # sleep in order not to overload server
-            time.sleep(10)
+            found.update(zip(chunk, distances))
 
-    return (origin, destinations)
+        cache.update(
+            ((origin_coords, coords), distance)
+            for (coords, distance) in found.items()
+            if distance != "?"
+        )
+
+    distances = [
+        cache.get((origin_coords, dest[2]), found.get(dest[2], "?"))
+        for dest in destinations
+    ]
+    return (origin, destinations, distances)
 
 
 def compute(args):
     # cli task entry point
+    fnames = ("origin_lat", "origin_long", "dest_lat", "dest_long", "distance")
     coordset = OrderedDict()
-    reader = csv.DictReader(args.source)
+    reader = csv.reader(args.source)
+    header = next(reader, None)
+
+    # an empty source produces an output with only the header
+    if header is None:
+        with args.output as fp:
+            csv.writer(fp).writerow(fnames)
+        return
+
+    idx = {name: i for (i, name) in enumerate(header)}
+    missing = [name for name in fnames[:-1] if name not in idx]
+    if missing:
+        errmsg = f"source is missing column(s): {', '.join(missing)}"
+        raise exc.ValidationError(errmsg)
+
+    origin_long, origin_lat = idx["origin_long"], idx["origin_lat"]
+    dest_lat, dest_long = idx["dest_lat"], idx["dest_long"]
+
     for row in reader:
-        origin_coord = (row["origin_long"], row["origin_lat"])
-        dest_coord = {k: row[k] for k in ("dest_long", "dest_lat")}
+        # skip blank lines
+        if not row:
+            continue
+
+        origin_coord = (row[origin_long], row[origin_lat])
+        dest_coord = (
+            row[dest_lat], row[dest_long],
+            _coords(row[dest_long], row[dest_lat])
+        )
 
         coords = coordset.setdefault(origin_coord, [])
-        coords.append(dest_coord) 
+        coords.append(dest_coord)
 
-    # process coordinates further
-    results = []
-    for (origin, destinations) in coordset.items():
-        result = compute_distances(origin, *destinations)
-        results.append(result)
+    concurrency = _concurrency()
+    throttle = _throttle()
 
-    fnames = ("origin_lat", "origin_long", "dest_lat", "dest_long", "distance")
-    with args.output as fp:
-        writer = csv.DictWriter(fp, fnames)
-        writer.writeheader()
-
-        for (origin, destinations) in results:
-            for dest in destinations:
-                row = {"origin_lat": origin[0], "origin_long": origin[1], **dest}
-                writer.writerow(row)
+    # initialize the context-local singletons before copying the context so
+    # all origins share the client's connection pool and the distance cache
+    get_client()
+    get_distance_cache()
+
+    def write_rows(writer, result):
+        (origin, destinations, distances) = result
+        writer.writerows(
+            (origin[1], origin[0], dest[0], dest[1], distance)
+            for (dest, distance) in zip(destinations, distances)
+        )
+
+    with args.output as fp, \
+            ThreadPoolExecutor(max_workers=concurrency) as executor:
+        writer = csv.writer(fp)
+        writer.writerow(fnames)
+
+        # process origins concurrently, keeping at most `concurrency` of them
+        # in flight and writing out rows in input order as they complete
+        pending = deque()
+        for (origin, destinations) in coordset.items():
+            context = contextvars.copy_context()
+            pending.append(executor.submit(
+                context.run, compute_distances, origin, *destinations,
+                throttle=throttle
+            ))
+            if len(pending) >= concurrency:
+                write_rows(writer, pending.popleft().result())
+
+        while pending:
+            write_rows(writer, pending.popleft().result())
@@ -0,0 +1,102 @@
+from types import SimpleNamespace
+
+import pytest
+
+from route import common
+from route import exceptions as exc
+from route.common import OSRMClient, OSRMService, Throttle
+
+
+def test_resolve_rejects_unhashable_value():
+    with pytest.raises(ValueError):
+        OSRMService.resolve(["table"])
+
+
+def test_resolve_accepts_names_and_values():
+    assert OSRMService.resolve("table") is OSRMService.TABLE
+    assert OSRMService.resolve("TABLE") is OSRMService.TABLE
+
+
+def response(status_code, headers=None):
+    return SimpleNamespace(status_code=status_code, headers=headers or {})
+
+
+def test_throttle_backs_off_and_recovers():
+    throttle = Throttle(0.5, max_interval=4.0)
+
+    assert throttle.update(response(429)) is True
+    assert throttle.update(response(503)) is True
+    assert throttle.interval == 2.0
+
+    for _ in range(3):
+        assert throttle.update(response(429)) is True
+    assert throttle.interval == 4.0
+
+    for _ in range(5):
+        assert throttle.update(response(200)) is False
+    assert throttle.interval == 0.5
+
+
+def test_throttle_honours_retry_after(monkeypatch):
+    monkeypatch.setattr(common.time, "monotonic", lambda: 100.0)
+    throttle = Throttle(0.5)
+    throttle.update(response(429, {"Retry-After": "7"}))
+    assert throttle._next == 107.0
+
+
+def test_throttle_rejects_invalid_interval():
+    with pytest.raises(ValueError):
+        Throttle(0)
+
+
+def test_build_config_service_keys_shadow_generic_ones(monkeypatch):
+    monkeypatch.setattr(common, "load_dotenv", lambda *args: None)
+    for key in list(common.os.environ):
+        if key.startswith("ROUTE__"):
+            monkeypatch.delenv(key)
+
+    monkeypatch.setenv("ROUTE__SERVICE", "osrm")
+    monkeypatch.setenv("ROUTE__OSRM__URLBASE", "http://osrm.test")
+    monkeypatch.setenv("ROUTE__URLBASE", "http://generic.test")
+    monkeypatch.setenv("ROUTE__CONCURRENCY", "4")
+    monkeypatch.setenv("ROUTE__GOOGLE__APIKEY", "secret")
+
+    assert common._build_config() == {
+        "service": "osrm",
+        "urlbase": "http://osrm.test",
+        "concurrency": "4",
+        "google.apikey": "secret",
+    }
+
+
+def test_client_merges_default_headers_with_provided_session():
+    class Session:
+        def get(self, url, headers=None, timeout=None):
+            self.headers = headers
+
+    session = Session()
+    client = OSRMClient("http://osrm.test", session=session)
+    client(payload={"coordinates": ["1,1", "2,2"]}, headers={"X-Test": "1"})
+    assert session.headers == {
+        "Accept-Encoding": "gzip, deflate",
+        "Connection": "keep-alive",
+        "X-Test": "1",
+    }
+
+
+def test_build_url_rejects_bare_coordinates_string():
+    client = OSRMClient("http://osrm.test")
+    with pytest.raises(exc.ValidationError):
+        client._build_url(coordinates="1,1")
+
+
+def test_build_url_accepts_coordinates_iterable():
+    client = OSRMClient("http://osrm.test")
+    url = client._build_url(coordinates=(c for c in ["1,1", "2,2"]))
+    assert url == "http://osrm.test/route/v1/car/1,1;2,2.json"
+
+
+def test_build_url_allows_braces_in_urlbase():
+    client = OSRMClient("http://osrm.test/{proxy}")
+    url = client._build_url(coordinates=["1,1", "2,2"])
+    assert url == "http://osrm.test/{proxy}/route/v1/car/1,1;2,2.json"
@@ -0,0 +1,274 @@
+import io
+import json
+import argparse
+from types import MappingProxyType
+from urllib.parse import urlsplit
+
+import pytest
+import requests
+
+from route import common
+from route import exceptions as exc
+from route import operations as ops
+from route.common import OSRMClient, Throttle
+
+
+class FakeResponse:
+    def __init__(self, data, status_code=200, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.content = json.dumps(data).encode()
+
+
+class FakeSession:
+    """Session stub which answers OSRM table and route requests using the
+    provided distances keyed by destination coordinates.
+    """
+    def __init__(self, distances=None, table_ok=True):
+        self.distances = distances or {}
+        self.table_ok = table_ok
+        self.urls = []
+
+    def get(self, url, headers=None, timeout=None):
+        self.urls.append(url)
+        parts = urlsplit(url)
+        (_, service, _, _, coords) = parts.path.split("/")
+        coords = coords[:-len(".json")].split(";")
+
+        if service == "table":
+            if not self.table_ok:
+                return FakeResponse({"code": "Ok", "distances": [[]]})
+            return FakeResponse({"code": "Ok", "distances": [
+                [self.distances.get(c) for c in coords[1:]]
+            ]})
+
+        distance = self.distances.get(coords[1])
+        routes = [{"distance": distance}] if distance is not None else []
+        return FakeResponse({"code": "Ok", "routes": routes})
+
+    def close(self):
+        pass
+
+
+class Output(io.StringIO):
+    def close(self):
+        self.value = self.getvalue()
+        super().close()
+
+
+CONFIG = {"urlbase": "http://osrm.test", "ratelimit": "1000"}
+
+
+@pytest.fixture
+def session(monkeypatch):
+    monkeypatch.setattr(common, "_config", MappingProxyType(CONFIG))
+    session = FakeSession()
+    client = OSRMClient("http://osrm.test", session=session)
+    client_token = common._client_var.set(client)
+    cache_token = common._distances_var.set({})
+    yield session
+    common._client_var.reset(client_token)
+    common._distances_var.reset(cache_token)
+
+
+def run_compute(source):
+    args = argparse.Namespace(source=io.StringIO(source), output=Output())
+    ops.compute(args)
+    return args.output.value.splitlines()
+
+
+def test_compute_skips_blank_lines(session):
+    session.distances = {"3.200000,6.600000": 1000}
+    rows = run_compute(
+        "origin_lat,origin_long,dest_lat,dest_long\n"
+        "6.5,3.1,6.6,3.2\n"
+        "\n"
+    )
+    assert rows == [
+        "origin_lat,origin_long,dest_lat,dest_long,distance",
+        "6.5,3.1,6.6,3.2,10.0",
+    ]
+
+
+def test_request_reports_failure_after_retries(session):
+    def client(payload):
+        calls.append(payload)
+        raise requests.ConnectionError("connection refused")
+
+    calls = []
+    assert ops._request(client, Throttle(0.001), {}) is None
+    assert len(calls) == ops.MAX_ATTEMPTS
+
+
+def test_throttle_rejects_invalid_ratelimit(session, monkeypatch):
+    monkeypatch.setattr(common, "_config", MappingProxyType(
+        dict(CONFIG, ratelimit="0")
+    ))
+    with pytest.raises(exc.ValidationError):
+        ops._throttle()
+
+
+def test_compute_writes_origin_lat_before_long(session):
+    session.distances = {
+        "3.200000,6.600000": 1000, "3.300000,6.700000": 2000
+    }
+    rows = run_compute(
+        "origin_long,origin_lat,dest_long,dest_lat\n"
+        "3.1,6.5,3.2,6.6\n"
+        "4.1,7.5,3.3,6.7\n"
+        "3.1,6.5,3.3,6.7\n"
+    )
+    assert rows == [
+        "origin_lat,origin_long,dest_lat,dest_long,distance",
+        "6.5,3.1,6.6,3.2,10.0",
+        "6.5,3.1,6.7,3.3,20.0",
+        "7.5,4.1,6.7,3.3,20.0",
+    ]
+
+
+def test_coords_formats_fixed_point():
+    assert ops._coords("0.00001", "6.5") == "0.000010,6.500000"
+    assert ops._coords("3.1000001", "6.5") == "3.100000,6.500000"
+
+
+@pytest.mark.parametrize("long, lat", [
+    ("x", "6.5"), ("3.1", ""), ("nan", "1")
+])
+def test_coords_rejects_invalid_values(long, lat):
+    assert ops._coords(long, lat) is None
+
+
+def test_compute_reports_invalid_coordinates(session):
+    session.distances = {"3.200000,6.600000": 1000}
+    rows = run_compute(
+        "origin_lat,origin_long,dest_lat,dest_long\n"
+        "6.5,3.1,6.6,3.2\n"
+        "6.5,3.1,abc,3.2\n"
+    )
+    assert rows[1:] == ["6.5,3.1,6.6,3.2,10.0", "6.5,3.1,abc,3.2,?"]
+    assert len(session.urls) == 1
+
+
+def test_compute_distances_deduplicates_and_caches(session):
+    session.distances = {"2.000000,2.000000": 1000}
+    dest = ("2", "2", "2.000000,2.000000")
+
+    (_, _, distances) = ops.compute_distances(("1", "1"), dest, dest)
+    assert distances == [10.0, 10.0]
+    assert len(session.urls) == 1
+    assert "1.000000,1.000000;2.000000,2.000000.json" in session.urls[0]
+    assert "destinations=1&" in session.urls[0]
+
+    # near-duplicate origin is served from the cache
+    (_, _, distances) = ops.compute_distances(("1.0000001", "1"), dest)
+    assert distances == [10.0]
+    assert len(session.urls) == 1
+
+
+def table_client(data, status_code=200):
+    return lambda payload: FakeResponse(data, status_code=status_code)
+
+
+def test_table_distances_parses_row():
+    client = table_client({"code": "Ok", "distances": [[1000, None, 250.5]]})
+    distances = ops._table_distances(
+        client, Throttle(0.001), "1,1", ["2,2", "3,3", "4,4"]
+    )
+    assert distances == [10.0, "?", 2.505]
+
+
+@pytest.mark.parametrize("data", [
+    {"code": "Ok", "distances": [[1000]]},
+    {"code": "Ok", "distances": []},
+    {"code": "NoTable"},
+])
+def test_table_distances_rejects_malformed_response(data):
+    distances = ops._table_distances(
+        table_client(data), Throttle(0.001), "1,1", ["2,2", "3,3"]
+    )
+    assert distances is None
+
+
+def test_compute_distances_uses_single_table_request(session):
+    session.distances = {"2.000000,2.000000": 1000}
+    (_, _, distances) = ops.compute_distances(
+        ("1", "1"), ("2", "2", "2.000000,2.000000"),
+        ("3", "3", "3.000000,3.000000")
+    )
+    assert distances == [10.0, "?"]
+    assert len(session.urls) == 1
+    assert "/table/v1/car/1.000000,1.000000;" in session.urls[0]
+    assert "annotations=distance" in session.urls[0]
+
+
+def test_compute_distances_chunks_table_requests(session, monkeypatch):
+    monkeypatch.setattr(common, "_config", MappingProxyType(
+        dict(CONFIG, **{"max.table.size": "3"})
+    ))
+    coords = [f"{i}.000000,{i}.000000" for i in range(2, 7)]
+    session.distances = {c: 100 * i for (i, c) in enumerate(coords)}
+
+    (_, _, distances) = ops.compute_distances(
+        ("1", "1"), *((c, c, c) for c in coords)
+    )
+    assert distances == [0.0, 1.0, 2.0, 3.0, 4.0]
+    assert len(session.urls) == 3
+    assert all("/table/" in url for url in session.urls)
+
+
+def test_compute_distances_falls_back_to_route_requests(session):
+    session.table_ok = False
+    session.distances = {"2.000000,2.000000": 1000}
+    (_, _, distances) = ops.compute_distances(
+        ("1", "1"), ("2", "2", "2.000000,2.000000"),
+        ("3", "3", "3.000000,3.000000")
+    )
+    assert distances == [10.0, "?"]
+    assert ["/table/" in url for url in session.urls] == [True, False, False]
+    assert sorted(urlsplit(url).path for url in session.urls[1:]) == [
+        "/route/v1/car/1.000000,1.000000;2.000000,2.000000.json",
+        "/route/v1/car/1.000000,1.000000;3.000000,3.000000.json",
+    ]
+
+
+def test_compute_writes_header_for_empty_source(session):
+    assert run_compute("") == [
+        "origin_lat,origin_long,dest_lat,dest_long,distance"
+    ]
+    assert session.urls == []
+
+
+def test_compute_rejects_missing_columns(session):
+    with pytest.raises(exc.ValidationError, match="dest_lat, dest_long"):
+        run_compute("origin_lat,origin_long\n6.5,3.1\n")
+
+
+@pytest.mark.parametrize("status_code", [400, 429, 503])
+def test_table_distances_reports_rejected_request(status_code):
+    client = table_client({"code": "TooBig"}, status_code=status_code)
+    distances = ops._table_distances(
+        client, Throttle(0.001), "1,1", ["2,2", "3,3"]
+    )
+    assert distances == ["?", "?"]
+
+
+def test_compute_distances_skips_fallback_when_server_pushes_back(session):
+    session.get = lambda url, **kwargs: (
+        session.urls.append(url) or FakeResponse({}, status_code=429)
+    )
+    (_, _, distances) = ops.compute_distances(
+        ("1", "1"), ("2", "2", "2.000000,2.000000"),
+        throttle=Throttle(0.001)
+    )
+    assert distances == ["?"]
+    assert len(session.urls) == ops.MAX_ATTEMPTS
+    assert all("/table/" in url for url in session.urls)
+
+
+@pytest.mark.parametrize("value", ["0", "-2", "many"])
+def test_concurrency_rejects_invalid_values(session, monkeypatch, value):
+    monkeypatch.setattr(common, "_config", MappingProxyType(
+        dict(CONFIG, concurrency=value)
+    ))
+    with pytest.raises(exc.ValidationError):
+        ops._concurrency()